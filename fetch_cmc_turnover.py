@@ -1,54 +1,87 @@
-import errno
+import argparse
+import asyncio
+import csv
+import hashlib
+import logging
 import os
+import pickle
 import platform
+import random
+import re
 import shutil
-import stat
-import subprocess
 import sys
-import tempfile
 import time
 import uuid
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
 ROOT_PATH = Path(__file__).resolve().parent
-from random import randint
 
+import aiohttp
+import orjson
 import pandas as pd
+import psutil
+from aiolimiter import AsyncLimiter
 import requests
-from joblib import Parallel, delayed
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.common.exceptions import NoSuchElementException, \
-    TimeoutException, StaleElementReferenceException, InvalidSelectorException
-from webdriver_manager.chrome import ChromeDriverManager
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
 from my_logger import get_logger
 logger = get_logger("app.turnover")
-chrome_options = Options()
-chrome_options.add_argument('--no-sandbox')  # 在centos运行需要打开
-chrome_options.add_argument('--disable-dev-shm-usage')    # 在centos运行需要打开
-chrome_options.add_argument("--headless")  # 无头模式，不显示浏览器界面
 pd.set_option('display.max_columns', None)
 pd.set_option('display.expand_frame_repr', False)
 
-TEST = False
-TEST_SYMBOLS = ["XEM", "DEFI"]
-OTHER_TEST_SYMBOL_NUM = 1  # 最小1
-PARALLEL = True
-RAND_WAIT_SEC = 0.5
-THREADS = 5
+# 运行参数 可以用环境变量覆盖，例如：CMC_TEST=1 CMC_THREADS=20 python fetch_cmc_turnover.py
+TEST = os.environ.get("CMC_TEST", "0").lower() in ("1", "true")
+TEST_SYMBOLS = [s for s in os.environ.get("CMC_TEST_SYMBOLS", "XEM,DEFI").split(",") if s]
+OTHER_TEST_SYMBOL_NUM = int(os.environ.get("CMC_OTHER_TEST_SYMBOL_NUM", 1))  # 最小1
+PARALLEL = os.environ.get("CMC_PARALLEL", "1").lower() in ("1", "true")
+RATE_LIMIT = int(os.environ.get("CMC_RATE_LIMIT", 20))  # 每秒最多请求数，令牌桶限速
+THREADS = int(os.environ.get("CMC_THREADS", 50))  # 异步并发请求数
 CSV_PATH = ROOT_PATH/"data"/"csv"
 CSV_PATH.mkdir(parents=True, exist_ok=True)
 CSV_FILE = CSV_PATH/"cmc_cap_vol_tor.csv" if TEST is False else ROOT_PATH/"data"/"temp"/"test.csv"
+CSV_COLUMNS = ['candle_begin_time', 'symbol', 'name', 'market_cap', 'vol', 'turnover_rate']
+CSV_FSYNC_ROWS = 50  # 每写入多少行 刷一次盘
+BACKUP_KEEP_DAYS = 7  # csv备份 保留天数
+# 按日期分区的parquet历史数据集，每轮追加小文件，不重写历史
+PARQUET_PATH = ROOT_PATH/"data"/"turnover" if TEST is False else ROOT_PATH/"data"/"temp"/"turnover"
+CACHE_PATH = ROOT_PATH/"data"/"cache"
+CACHE_PATH.mkdir(parents=True, exist_ok=True)
+PAIRS_CACHE_TTL = 86400  # 币对列表 很少变化，缓存1天
+DETAIL_CACHE_TTL = 3600  # 详情接口 缓存1小时，并且只在同一个 candle_begin_time 内有效
 
 # cmc页面上有错误数据，此手写列表用来修正错误
 # 包含"KNC"的symbol，用指定的str作为name
 STATIC_LIST = {
     "KNC": "kyber-network-crystal-v2",
 }
-
-
-def retry_wrapper(func, func_name='', retry_times=5, sleep_seconds=5, if_exit=True, **params):
+# STATIC_LIST 为空时 不编译，空正则会匹配所有 symbol
+STATIC_RE = re.compile("|".join(map(re.escape, STATIC_LIST))) if STATIC_LIST else None
+
+HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+                         'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36'}
+# 所有同步请求 共用一个Session，复用 TCP+TLS 连接
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=THREADS, pool_maxsize=THREADS,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+))
+SESSION.headers.update(HEADERS)
+# binance USDT 永续合约 币对列表接口，分页获取，每页 MARKET_PAIRS_LIMIT 个
+MARKET_PAIRS_URL = "https://api.coinmarketcap.com/data-api/v3/exchange/market-pairs/latest?" \
+                   "slug=binance&category=perpetual&start={}&quoteCurrencyId=825&limit={}"
+MARKET_PAIRS_LIMIT = 200
+# cmc 币种详情接口，直接返回json，不需要浏览器渲染页面
+CMC_DETAIL_URL = "https://api.coinmarketcap.com/data-api/v3/cryptocurrency/detail/lite?slug={}"
+
+
+def retry_sleep_time(sleep_seconds, attempt, max_sleep):
+    # 指数退避 + 随机抖动，避免多个并发请求 在同一时刻 一起重试
+    return min(sleep_seconds * (2 ** attempt) * random.uniform(0.5, 1.5), max_sleep)
+
+
+def retry_wrapper(func, func_name='', retry_times=5, sleep_seconds=5, max_sleep=60, if_exit=True, **params):
     """
     需要在出错时不断重试的函数，例如和交易所交互，可以使用本函数调用。
 
@@ -56,65 +89,164 @@ def retry_wrapper(func, func_name='', retry_times=5, sleep_seconds=5, if_exit=Tr
     :param params:          参数
     :param func_name:       方法名称
     :param retry_times:     重试次数
-    :param sleep_seconds:   报错后的sleep时间
+    :param sleep_seconds:   报错后的sleep基准时间，每次重试翻倍并加随机抖动
+    :param max_sleep:       单次sleep的上限
     :param if_exit:         报错超过上限是否退出
     :return:                func运行的结果
     """
-    for _ in range(retry_times):
+    for attempt in range(retry_times):
+        # 最后一次失败后 直接结束，不再sleep
+        _sleep = retry_sleep_time(sleep_seconds, attempt, max_sleep) if attempt < retry_times - 1 else 0
         try:
             result = func(**params)
+            return result
+        except requests.exceptions.Timeout as err:
+            logger.error("%s 超时，%.1f 秒后重试: %s", func_name, _sleep, err)
+            if _sleep: time.sleep(_sleep)
+        except Exception as err:
+            logger.error("%s 报错，程序暂停 %.1f 秒： %s", func_name, _sleep, err)
+            logger.exception(err)
+            if _sleep: time.sleep(_sleep)
+    else:
+        if if_exit:
+            raise RuntimeError(f'{func_name} 重试无效，程序退出')
+        else:
+            logger.error("%s 重试无效，程序不退出，跳过", func_name)
 
-            # 对 爬取到的 元素值 做特殊处理，如果取回是 $0 则重新爬取
-            if "fetch_web_element" in func_name and result.text == "$0":
-                logger.debug(f"{func_name} 爬取 到 $0, {sleep_seconds} 秒后 重试")
-                time.sleep(sleep_seconds)
-                continue
 
+async def async_retry_wrapper(func, func_name='', retry_times=5, sleep_seconds=5, max_sleep=60, if_exit=True,
+                              **params):
+    """
+    retry_wrapper 的协程版本，func 需要是 async 函数，重试等待 不阻塞事件循环。
+
+    :param func:            需要重试的协程函数
+    :param params:          参数
+    :param func_name:       方法名称
+    :param retry_times:     重试次数
+    :param sleep_seconds:   报错后的sleep基准时间，每次重试翻倍并加随机抖动
+    :param max_sleep:       单次sleep的上限
+    :param if_exit:         报错超过上限是否退出
+    :return:                func运行的结果
+    """
+    for attempt in range(retry_times):
+        # 最后一次失败后 直接结束，不再sleep
+        _sleep = retry_sleep_time(sleep_seconds, attempt, max_sleep) if attempt < retry_times - 1 else 0
+        try:
+            result = await func(**params)
             return result
-        except NoSuchElementException:
-            # 如果是 未找到元素 异常，则不处理，原样抛出
-            raise
-        except TimeoutException as err:
-            logger.error(f"{func_name} 超时，{sleep_seconds} 秒后重试: {err}")
-            time.sleep(sleep_seconds)
-        except OSError as err:
-            # 如果是OSError: [Errno 26] Text file busy: 'chromedriver'，暂停重试 通常就没问题
-            if err.errno == errno.ETXTBSY:
-                logger.error(f"{func_name} 访问冲突，{sleep_seconds} 秒后重试: {err}")
-                time.sleep(sleep_seconds)
-            else:
-                logger.error(f"{func_name} 报错，程序暂停 {sleep_seconds} 秒： {err}")
-                time.sleep(sleep_seconds)
+        except asyncio.TimeoutError as err:
+            logger.error("%s 超时，%.1f 秒后重试: %s", func_name, _sleep, err)
+            if _sleep: await asyncio.sleep(_sleep)
         except Exception as err:
-            logger.error(f"{func_name} 报错，程序暂停 {sleep_seconds} 秒： {err}")
+            logger.error("%s 报错，程序暂停 %.1f 秒： %s", func_name, _sleep, err)
             logger.exception(err)
-            time.sleep(sleep_seconds)
+            if _sleep: await asyncio.sleep(_sleep)
     else:
         if if_exit:
             raise RuntimeError(f'{func_name} 重试无效，程序退出')
         else:
-            logger.error(f'{func_name} 重试无效，程序不退出，跳过')
+            logger.error("%s 重试无效，程序不退出，跳过", func_name)
+
+
+def _cache_file(url):
+    return CACHE_PATH / f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}.pkl"
+
+
+def current_hour():
+    # 当前时间 截断到小时，和 candle_begin_time 对齐
+    return datetime.now().replace(minute=0, second=0, microsecond=0)
+
+
+def cache_load(url, ttl, not_before=None):
+    """
+    读取 url 对应的本地缓存，未过期则返回缓存的json，否则返回None
+    :param url:
+    :param ttl:         缓存有效秒数
+    :param not_before:  datetime，早于该时间写入的缓存 视为过期
+    :return:
+    """
+    _file = _cache_file(url)
+    try:
+        with open(_file, "rb") as f:
+            _cached = pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError):
+        return None
+
+    if not_before is not None and _cached["timestamp"] < not_before.timestamp():
+        return None
+    if time.time() - _cached["timestamp"] < ttl:
+        return _cached["json"]
+    return None
+
+
+def cache_save(url, body):
+    # 先写临时文件再替换，避免并发读到写了一半的缓存
+    _file = _cache_file(url)
+    _tmp = _file.with_name(f"{_file.name}.{os.getpid()}.{uuid.uuid4().hex}")
+    with open(_tmp, "wb") as f:
+        pickle.dump({"timestamp": time.time(), "json": body}, f)
+    os.replace(_tmp, _file)
 
 
-def get_cmc_market_pairs():
-    url_entry = "https://api.coinmarketcap.com/data-api/v3/exchange/market-pairs/latest?" \
-                "slug=binance&category=perpetual&start=1&quoteCurrencyId=825&limit=200"
+def cached_get(url, ttl, force_refresh=False, not_before=None):
+    """
+    带本地TTL缓存的 GET 请求，返回json
+    :param url:
+    :param ttl:             缓存有效秒数
+    :param force_refresh:   为True时跳过缓存，直接请求
+    :param not_before:      datetime，早于该时间写入的缓存 视为过期
+    :return:
+    """
+    if not force_refresh:
+        body = cache_load(url, ttl, not_before=not_before)
+        if body is not None:
+            logger.debug("命中缓存: %s", url)
+            return body
+
+    r = SESSION.get(url, timeout=10)
+    r.raise_for_status()
+    body = orjson.loads(r.content)
+    # 只缓存 带有数据 的返回，避免把cmc的错误信息缓存下来
+    if body.get("data"):
+        cache_save(url, body)
+    return body
+
 
-    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-                             'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36'}
+def fetch_market_pairs_page(start, force_refresh=False):
+    url = MARKET_PAIRS_URL.format(start, MARKET_PAIRS_LIMIT)
+    return cached_get(url, PAIRS_CACHE_TTL, force_refresh=force_refresh)["data"]
 
+
+def get_cmc_market_pairs(force_refresh=False):
     try:
-        r = requests.get(url_entry, headers=headers)
-        r = r.json()
-        marketPairs = r["data"]["marketPairs"]
+        # 第一页 同时返回 币对总数，剩余的页 用共享的SESSION 并发请求
+        first_page = fetch_market_pairs_page(1, force_refresh)
+        marketPairs = first_page["marketPairs"]
+        total = first_page.get("numMarketPairs")
+
+        if total:
+            starts = list(range(1 + MARKET_PAIRS_LIMIT, total + 1, MARKET_PAIRS_LIMIT))
+            if starts:
+                with ThreadPoolExecutor(max_workers=min(len(starts), THREADS)) as ex:
+                    for page in ex.map(lambda _start: fetch_market_pairs_page(_start, force_refresh), starts):
+                        marketPairs.extend(page["marketPairs"])
+        else:
+            # 没有返回总数时，逐页请求，直到某一页 不满 limit
+            page_pairs = marketPairs
+            start = 1
+            while len(page_pairs) == MARKET_PAIRS_LIMIT:
+                start += MARKET_PAIRS_LIMIT
+                page_pairs = fetch_market_pairs_page(start, force_refresh)["marketPairs"]
+                marketPairs.extend(page_pairs)
 
         # 用 固定 list 进行修正
-        for p in marketPairs:
-            for symbol, slug in STATIC_LIST.items():
-                if symbol in p['marketPair']:
-                    slug_ori = p['baseCurrencySlug']
-                    p['baseCurrencySlug'] = slug
-                    logger.info(f"手动修正：{p['marketPair']} 用 {slug} 替换 {slug_ori}")
+        for p in marketPairs if STATIC_RE else []:
+            m = STATIC_RE.search(p['marketPair'])
+            if m:
+                slug = STATIC_LIST[m.group(0)]
+                slug_ori = p['baseCurrencySlug']
+                p['baseCurrencySlug'] = slug
+                logger.info("手动修正：%s 用 %s 替换 %s", p['marketPair'], slug, slug_ori)
 
         return marketPairs
     except Exception as e:
@@ -122,266 +254,255 @@ def get_cmc_market_pairs():
         return None
 
 
-def get_cmc_turnover_rate(_name, _symbol, _driver):
-    page_url = f"https://coinmarketcap.com/currencies/{_name}"
-    logger.debug(f"{page_url}")
+def get_cmc_turnover_rate(_name, _symbol):
+    """
+    只获取 cmc 币种 24h 换手率，和 get_cmc_cap_vol_tor 共用 详情接口
+    :param _name:
+    :param _symbol:
+    :return:
+    """
+    _cap, _vol, _tor = get_cmc_cap_vol_tor(_name, _symbol, current_hour())
+    return round(_tor, 4) if _tor != -1.0 else _tor
 
-    retry_wrapper(_driver.get, func_name=f"webpage {_symbol}", sleep_seconds=2, if_exit=False, url=page_url)
 
-    pct = -1.0
+def fetch_cmc_detail(_name, run_hour, force_refresh=False):
+    # 详情缓存 按小时对齐，上一个小时的数据 不会被记到这一小时的 candle_begin_time 上
+    body = cached_get(CMC_DETAIL_URL.format(_name), DETAIL_CACHE_TTL, force_refresh=force_refresh,
+                      not_before=run_hour)
+    return body["data"]
 
-    selectors = [
-        'dd.sc-8755d3ba-0.eXRmzO.base-text',
-        'div.priceValue',
-    ]
-    # 尝试使用多个 CSS 选择器
-    percent_element = None
-    for selector in selectors:
-        try:
-            percent_element = _driver.find_elements_by_css_selector(selector)
-            # logger.debug(percent_element)
-            if percent_element:
-                logger.debug(f"{_symbol} 父元素 {selector} 匹配")
-                break
-        except NoSuchElementException:
-            logger.debug(f"{_symbol} 父元素 {selector} 不匹配")
-            continue
 
-    if percent_element:
-        for e in percent_element:
-            try:
-                _text = e.text
-
-                if "%" in _text:
-                    pct = _text.replace("%", "")
-                    pct = float(pct)
-                    pct /= 100
-                    pct = round(pct, 4)
-                    logger.debug(f"{_symbol} 子元素 {_text} 匹配")
-                    break
-                elif 0 < float(_text) < 1:
-                    pct = float(_text)
-                    pct = round(pct, 4)
-                    logger.debug(f"{_symbol} 子元素 {_text} 匹配")
-                    break
-            except StaleElementReferenceException as err:
-                logger.error(f"{_symbol} 获取 子元素 文本 失败，跳过: {err}")
-                continue
-            except Exception as err:
-                logger.debug(f"{_symbol} 子元素 {_text} 不匹配: {err}")
-                continue
-    else:
-        logger.warning(f"{_symbol} 父元素 最终失败")
+async def fetch_cmc_detail_async(session, limiter, _name, run_hour, force_refresh=False):
+    url = CMC_DETAIL_URL.format(_name)
+    if not force_refresh:
+        body = cache_load(url, DETAIL_CACHE_TTL, not_before=run_hour)
+        if body is not None:
+            logger.debug("命中缓存: %s", url)
+            return body["data"]
+
+    # 命中缓存不占用限速额度，只有真正发请求时 才经过令牌桶
+    async with limiter:
+        async with session.get(url) as r:
+            r.raise_for_status()
+            body = orjson.loads(await r.read())
+    if body.get("data"):
+        cache_save(url, body)
+    return body["data"]
+
 
-    # driver.quit()
-    if pct == -1.0: logger.warning(f"{_symbol} 子元素 最终失败")
-    return pct
+def parse_cap_vol_tor(_data, _symbol):
+    """
+    从 cmc 币种详情json 中解析 流通市值、24h成交量，并计算 换手率
+    :param _data:   详情接口返回的 data 字段
+    :param _symbol:
+    :return:        (流通市值, 成交量, 换手率)，取不到的值为 -1.0
+    """
+    _cap = -1.0
+    _vol = -1.0
+    _tor = -1.0
+
+    _stats = _data.get("statistics") or {}
+
+    # 获取 流通市值
+    try:
+        _cap = float(_stats["marketCap"])
+        logger.debug("%s 流通市值 找到 %s", _symbol, _cap)
+    except (KeyError, TypeError, ValueError) as err:
+        if _symbol != "DEFI/USDT":  # DEFI本身就没有数据，跳过告警
+            logger.error("%s 获取 流通市值 报错: %s", _symbol, err)
+
+    # 获取 成交量，新版接口放在statistics里，旧版放在data下
+    try:
+        _vol = float(_stats.get("volume24h", _data.get("volume")))
+        logger.debug("%s 成交量 找到 %s", _symbol, _vol)
+    except (TypeError, ValueError) as err:
+        if _symbol != "DEFI/USDT":
+            logger.error("%s 获取 成交量 报错: %s", _symbol, err)
+
+    # 计算 换手率 = 成交量 / 流通市值
+    if _cap > 0 and _vol >= 0:
+        _tor = _vol / _cap
+        logger.debug("%s 换手率 计算 %s", _symbol, _tor)
+
+    if _cap == -1.0: logger.warning("%s 流通市值 最终失败", _symbol)
+    if _vol == -1.0: logger.warning("%s 成交量 最终失败", _symbol)
+    if _tor == -1.0: logger.warning("%s 换手率 最终失败", _symbol)
+
+    return _cap, _vol, _tor
 
 
-def get_cmc_cap_vol_tor(_name, _symbol, _driver):
+def get_cmc_cap_vol_tor(_name, _symbol, run_hour):
     """
-    获取cmc 币种页面 中的：
+    获取cmc 币种详情接口 中的：
         1、流通市值
-        2、24h CEX成交量
+        2、24h 成交量
         3、24h 换手率
-    举例：https://coinmarketcap.com/currencies/qtum/
+    举例：https://api.coinmarketcap.com/data-api/v3/cryptocurrency/detail/lite?slug=qtum
     :param _name:
     :param _symbol:
-    :param _driver:
+    :param run_hour:    本轮的 candle_begin_time
     :return:
     """
-    page_url = f"https://coinmarketcap.com/currencies/{_name}"
-    logger.debug(f"{page_url}")
+    logger.debug(CMC_DETAIL_URL.format(_name))
 
-    retry_wrapper(_driver.get, func_name=f"access webpage {_symbol}", sleep_seconds=2, if_exit=False, url=page_url)
+    _data = retry_wrapper(fetch_cmc_detail, func_name=f"access api {_symbol}", sleep_seconds=2, if_exit=False,
+                          _name=_name, run_hour=run_hour)
+    if _data is None:
+        logger.warning("%s 详情接口 最终失败", _symbol)
+        return -1.0, -1.0, -1.0
 
-    _cap = -1.0
-    _vol = -1.0
-    _tor = -1.0
+    return parse_cap_vol_tor(_data, _symbol)
 
-    # 获取 流通市值
-    # 多个xpath，逐一尝试
-    _cap_xpaths = [
-        r"//div[contains(@class, 'cPJgvg')][.//dt[contains(text(), 'Market cap') and not(contains(text(), 'Volume'))]]//dd[@class='sc-8755d3ba-0 eXRmzO base-text']",
-        "//div[contains(@class, 'statsBlockInner')][.//div[contains(text(), 'Market Cap') and not(contains(text(), '24h Volume / Market Cap'))]]//div[@class='statsValue']",
-        "//*[@id='section-coin-stats']/div/dl/div[1]/div[1]/dd",
-        "//*[@id='__next']/div/div[1]/div[2]/div/div[1]/div[2]/div/div[3]/div[1]/div[1]/div[1]/div[2]/div",
-        "//*[@id='__next']/div/div[1]/div[2]/div/div[1]/div[3]/div/div[3]/div[1]/div[1]/div[1]/div[2]/div",
-    ]
-    for x in _cap_xpaths:
-        try:
-            # _cap_item = _driver.find_element_by_xpath(xpath=x)
-            _cap_item = retry_wrapper(_driver.find_element_by_xpath, func_name=f"fetch_web_element {_symbol} cap",
-                                      sleep_seconds=2, if_exit=False,
-                                      xpath=x)
-            _cap_str = _cap_item.text
-            _cap_str = _cap_str.replace("$", "").replace(",", "")
-            _cap = float(_cap_str)
-
-            logger.debug(f"{_symbol} 流通市值 找到 {_cap}")
-            break
-        except NoSuchElementException as err:
-            # logger.debug(f"{_symbol} 获取 流通市值 未找到，继续搜索: {err}")
-            continue
-        except StaleElementReferenceException as err:
-            logger.error(f"{_symbol} 获取 流通市值 元素失效，继续搜索: {err}")
-            continue
-        except Exception as err:
-            if _symbol != "DEFI/USDT":  # DEFI本身就没有数据，跳过告警
-                logger.error(f"{_symbol} 获取 流通市值 报错，继续搜索: {err}")
-                logger.exception(err)
-            continue
-    if _cap == -1.0: logger.warning(f"{_symbol} 流通市值 最终失败")
-
-    # 获取 成交量
-    _vol_xpaths = [
-        '//div[contains(@class, "cPJgvg")][.//dt[contains(text(), "Volume (24h)") and not(contains(text(), "Volume/Market cap"))]]//dd[@class="sc-8755d3ba-0 eXRmzO base-text"]',
-        '//div[contains(@class, "statsBlockInner")][.//div[contains(@class, "statsLabel") and contains(text(), "Volume") and not(contains(text(), "24h Volume / Market Cap"))]]//div[@class="statsValue"]',
-        '//*[@id="section-coin-stats"]/div/dl/div[2]/div[1]/dd',
-        '//*[@id="__next"]/div/div[1]/div[2]/div/div[1]/div[2]/div/div[3]/div[1]/div[3]/div[1]/div[2]/div',
-        '//*[@id="__next"]/div/div[1]/div[2]/div/div[1]/div[3]/div/div[3]/div[1]/div[3]/div[1]/div[2]/div',
-    ]
-    for x in _vol_xpaths:
-        try:
-            # _vol_item = _driver.find_element_by_xpath(x)
-            _vol_item = retry_wrapper(_driver.find_element_by_xpath, func_name=f"fetch_web_element {_symbol} vol",
-                                      sleep_seconds=2, if_exit=False,
-                                      xpath=x)
-            _vol_str = _vol_item.text
-            _vol_str = _vol_str.replace("$", "").replace(",", "")
-            _vol = float(_vol_str)
-
-            logger.debug(f"{_symbol} 成交量 找到 {_vol}")
-            break
-        except NoSuchElementException as err:
-            continue
-        except StaleElementReferenceException as err:
-            logger.error(f"{_symbol} 获取 成交量 元素失效，继续搜索: {err}")
-            continue
-        except Exception as err:
-            if _symbol != "DEFI/USDT":  # DEFI本身就没有数据，跳过告警
-                logger.error(f"{_symbol} 获取 成交量 报错，继续搜索: {err}")
-                logger.exception(err)
-            continue
-    if _vol == -1.0: logger.warning(f"{_symbol} 成交量 最终失败")
-
-    # 获取 换手率
-    _tor_xpaths = [
-        '//div[contains(@class, "cPJgvg")][.//dt[contains(text(), "Volume/Market cap")]]//dd[@class="sc-8755d3ba-0 eXRmzO base-text"]',
-        '//div[contains(@class, "statsBlockInner")][.//div[contains(text(), "24h Volume / Market Cap")]]//div[@class="priceValue"]',
-        '//*[@id="section-coin-stats"]/div/dl/div[3]/div/dd',
-        '//*[@id="__next"]/div/div[1]/div[2]/div/div[1]/div[2]/div/div[3]/div[1]/div[1]/div[2]/div/div[2]',
-        '//*[@id="__next"]/div/div[1]/div[2]/div/div[1]/div[3]/div/div[3]/div[1]/div[1]/div[3]/div/div[2]',
-    ]
-    for x in _tor_xpaths:
-        try:
-            # _tor_item = _driver.find_element_by_xpath(x)
-            _tor_item = retry_wrapper(_driver.find_element_by_xpath, func_name=f"fetch_web_element {_symbol} tor",
-                                      sleep_seconds=2, if_exit=False,
-                                      xpath=x)
-            _tor_str = _tor_item.text
-            _tor_str = _tor_str.replace("%", "")
-            _tor = float(_tor_str)
-            _tor = _tor if 0 <= _tor <= 1 else _tor / 100
-
-            logger.debug(f"{_symbol} 换手率 找到 {_tor}")
-            break
-
-        except NoSuchElementException as err:
-            # logger.debug(f"{_symbol} 获取 换手率 未找到，继续搜索: {err}")
-            # logger.exception(err)
-            continue
-        except StaleElementReferenceException as err:
-            logger.error(f"{_symbol} 获取 换手率 元素失效，继续搜索: {err}")
-            logger.exception(err)
-            continue
-        except Exception as err:
-            if _symbol != "DEFI/USDT":  # DEFI本身就没有数据，跳过告警
-                logger.error(f"{_symbol} 获取 换手率 报错，继续搜索: {err}")
-                logger.exception(err)
-            continue
-    if _tor == -1.0: logger.warning(f"{_symbol} 换手率 最终失败")
 
-    return _cap, _vol, _tor
+def build_record(run_hour, _name, _symbol, _cap, _vol, _tor):
+    record = {
+        'candle_begin_time': run_hour,
+        'symbol': _symbol,
+        'name': _name,
+        'market_cap': _cap,  # 流通市值
+        'vol': _vol,  # 24h CEX交易量
+        'turnover_rate': _tor,  # 换手率
+    }
 
+    logger.debug("%s 爬取 完成 cap=%s vol=%s tor=%s", _symbol, _cap, _vol, _tor)
+    return record
 
-def save_for_one(pair, driver_path):
-    _ms = int(RAND_WAIT_SEC * 1000)
-    time.sleep(randint(_ms, _ms*2)/1000)
 
+def save_for_one(pair, run_hour):
     _name = pair["baseCurrencySlug"]
     _symbol = pair["marketPair"]
 
-    # 为每个线程创建独立的drvier，防止冲突
-    temp_dir = Path(tempfile.mkdtemp(dir=str(ROOT_PATH/"data"/"temp")))
-    temp_file = temp_dir / "chromedriver"
-    shutil.copy(driver_path, str(temp_file))
+    _cap, _vol, _tor = get_cmc_cap_vol_tor(_name, _symbol, run_hour)
+    return build_record(run_hour, _name, _symbol, _cap, _vol, _tor)
+
+
+async def fetch_one(session, semaphore, limiter, pair, run_hour):
+    _name = pair["baseCurrencySlug"]
+    _symbol = pair["marketPair"]
+    logger.debug(CMC_DETAIL_URL.format(_name))
 
-    driver = retry_wrapper(webdriver.Chrome, func_name=f"{_symbol} create webdriver.Chrome",
-                           retry_times=3, sleep_seconds=1, if_exit=False,
-                           executable_path=str(temp_file), options=chrome_options)
+    # 用 semaphore 限制 同时在途的请求数，避免一次性打满cmc
+    async with semaphore:
+        _data = await async_retry_wrapper(fetch_cmc_detail_async, func_name=f"access api {_symbol}",
+                                          sleep_seconds=2, if_exit=False,
+                                          session=session, limiter=limiter, _name=_name, run_hour=run_hour)
 
-    _cap, _vol, _tor = get_cmc_cap_vol_tor(_name, _symbol, driver)
+    if _data is None:
+        logger.warning("%s 详情接口 最终失败", _symbol)
+        _cap, _vol, _tor = -1.0, -1.0, -1.0
+    else:
+        _cap, _vol, _tor = parse_cap_vol_tor(_data, _symbol)
 
-    # 清理driver和临时目录
-    driver.quit()
-    shutil.rmtree(temp_dir)
+    return build_record(run_hour, _name, _symbol, _cap, _vol, _tor)
 
-    # 获取当前时间并将分钟和秒设置为0，以便时间戳仅精确到小时
-    _now = datetime.now().replace(minute=0, second=0, microsecond=0)
-    df = pd.DataFrame({
-        'candle_begin_time': [_now],
-        'symbol': [_symbol],
-        'name': [_name],
-        'market_cap': [_cap],  # 流通市值
-        'vol': [_vol],  # 24h CEX交易量
-        'turnover_rate': [_tor],  # 换手率
-    })
 
-    logger.info(f"{_symbol} 爬取 完成:\n{df}")
-    return df
+async def main_async(cmc_pairs, run_hour, on_record):
+    """
+    并发爬取所有币种，每完成一个 就交给 on_record 处理，不等全部结束
+    """
+    semaphore = asyncio.Semaphore(THREADS)
+    limiter = AsyncLimiter(RATE_LIMIT, time_period=1)
+    timeout = aiohttp.ClientTimeout(total=10)
+    connector = aiohttp.TCPConnector(limit=THREADS)
+    async with aiohttp.ClientSession(headers=HEADERS, timeout=timeout, connector=connector) as session:
+        tasks = [fetch_one(session, semaphore, limiter, p, run_hour) for p in cmc_pairs]
+        for fut in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+            on_record(await fut)
 
 
 def format_csv():
-    _df = pd.read_csv(str(CSV_FILE))
-    _df = _df.sort_values(by=['symbol', 'candle_begin_time'])
+    # symbol/name 重复度高，用category节省内存；candle_begin_time 读入时直接解析成datetime
+    dtypes = {"symbol": "category", "name": "category"}
+    _df = pd.read_csv(str(CSV_FILE), parse_dates=["candle_begin_time"], dtype=dtypes)
+    # csv是追加写入的，文件顺序即写入顺序，直接保留最后一条，不需要先排序
     _df = _df.drop_duplicates(subset=['symbol', 'candle_begin_time'], keep='last')
-    _df = _df.sort_values(by="candle_begin_time")
+    _df = _df.sort_values(by=['candle_begin_time', 'symbol'], kind='stable')
     _df = _df.reset_index(drop=True)
-    _df.to_csv(str(CSV_FILE), index=False)
+    # 先写临时文件再替换，csv换成新的inode，硬链接的备份 仍然保留整理前的内容
+    _tmp = CSV_FILE.with_name(f".{CSV_FILE.name}.tmp")
+    _df.to_csv(str(_tmp), index=False)
+    os.replace(_tmp, CSV_FILE)
     return _df
 
 
+def get_done_symbols(_hour):
+    """
+    读取parquet中 candle_begin_time 为 _hour 的 symbol，用于 同一小时内重跑时 跳过
+    只读 当前小时 的几个小文件，不扫描全部历史；parquet里 只有爬取成功的行
+    :param _hour:
+    :return:    symbol集合
+    """
+    _files = list((PARQUET_PATH / f"date={_hour:%Y-%m-%d}").glob(f"part-{_hour:%H}-*.parquet"))
+    if not _files:
+        return set()
+
+    _df = pd.concat([pd.read_parquet(str(f), columns=["symbol"]) for f in _files], ignore_index=True)
+    return set(_df["symbol"])
+
+
+def save_parquet(_df):
+    """
+    把数据 追加写入 parquet数据集，按 candle_begin_time 分区：date=YYYY-MM-DD/part-HH-xxxxxxxx.parquet
+    每小时的数据 只新增小文件，不重写历史；下游读取时 可以按日期过滤分区，不用扫描全部历史
+    只写入 爬取成功 的行：失败的币种 同一小时重跑时 会重新爬取，成功后 才写入，不会产生重复行
+    :param _df:
+    :return:
+    """
+    _df = _df[_df["turnover_rate"] != -1.0]
+    for _time, _group in _df.groupby(_df["candle_begin_time"].dt.floor("H")):
+        _dir = PARQUET_PATH / f"date={_time:%Y-%m-%d}"
+        _dir.mkdir(parents=True, exist_ok=True)
+        _file = _dir / f"part-{_time:%H}-{uuid.uuid4().hex[:8]}.parquet"
+        _group.to_parquet(str(_file), engine="pyarrow", compression="zstd", index=False)
+
+
 def backup_csv():
     if CSV_FILE.exists():
         _df = pd.read_csv(str(CSV_FILE))
         last_time = _df.iloc[-1]["candle_begin_time"].replace(" ", "_").replace(":", "-")
         backup_path = CSV_FILE.with_name(CSV_FILE.stem + CSV_FILE.suffix + f".{last_time}")
-        shutil.copy(CSV_FILE, backup_path)
+        if backup_path.exists():
+            backup_path.unlink()
+        # 用硬链接做快照，不复制数据；文件系统不支持硬链接时 退回到复制
+        # csv之后只会追加写入，整理时 先写临时文件再替换，所以 备份里的已有数据 不会被破坏
+        try:
+            os.link(CSV_FILE, backup_path)
+        except OSError:
+            shutil.copyfile(CSV_FILE, backup_path)
+        clean_backups(backup_path)
         return backup_path
     else:
         return None
 
 
-def clear_chrom():
-    system = platform.system()
-    if system == "Linux":
-        os.system("pkill -f chrom")
+def clean_backups(keep_path):
+    """
+    删除 超过保留天数 的csv备份，控制磁盘占用
+    备份是硬链接，mtime 和 当前csv 相同，所以 按文件名里的 candle_begin_time 判断是否过期
+    :param keep_path:   本次刚生成的备份，无论多旧 都不删除
+    :return:
+    """
+    expire_time = datetime.now() - timedelta(days=BACKUP_KEEP_DAYS)
+    for f in CSV_FILE.parent.glob(f"{CSV_FILE.name}.*"):
+        if f == keep_path:
+            continue
+        try:
+            backup_time = datetime.strptime(f.name[len(CSV_FILE.name) + 1:], "%Y-%m-%d_%H-%M-%S")
+        except ValueError:
+            continue
+        if backup_time < expire_time:
+            f.unlink()
+            logger.debug("删除过期备份 %s", f.name)
 
 
 def check_running():
     main_program_name = os.path.basename(sys.argv[0])
     current_pid = os.getpid()  # 获取pid，排除检查自己
-    command = "ps ax -o pid,args"
-    process_list = subprocess.check_output(command, shell=True, text=True)
-    process_lines = process_list.strip().split("\n")
-
-    for line in process_lines[1:]:  # 跳过表头行
-        pid, args = line.strip().split(maxsplit=1)
 
-        if int(pid) != current_pid and main_program_name in args:
-            logger.info(f"爬虫 主程序 {main_program_name} 已经有进程，本次不运行，退出")
-            exit()
+    for p in psutil.process_iter(['pid', 'cmdline']):
+        if p.info['pid'] != current_pid and main_program_name in " ".join(p.info['cmdline'] or []):
+            logger.info("爬虫 主程序 %s 已经有进程，本次不运行，退出", main_program_name)
+            sys.exit()
 
 
 def main():
@@ -389,13 +510,6 @@ def main():
     if platform.system() == "Linux":
         check_running()
 
-    # 备份当前csv，以防破坏已有数据，备份文件名 是最后写入的 candle_begin_time
-    bk_file = backup_csv()
-    if isinstance(bk_file, Path) and bk_file.exists():
-        logger.info(f"备份csv 完成")
-    else:
-        logger.warning(f"备份csv 失败，请检查，程序继续")
-
     # 获取cmc symbol列表，当前获取的是binance USDT prep币种
     cmc_pairs = get_cmc_market_pairs()
     # 如果是测试局，减少币种数量，可以指定 测试币种
@@ -406,45 +520,88 @@ def main():
             for p in cmc_pairs_ori:
                 if s in p["marketPair"]: cmc_pairs.append(p)
 
-    # 单线程 或者 多线程 爬取内容
-    # 单线程 约 30分钟 一轮，多线程约 20 分钟 一轮
-    driver_path = ChromeDriverManager().install()
-    dfs = []
-    if PARALLEL is False:
-        global RAND_WAIT_SEC
-        RAND_WAIT_SEC = 0
-        for pair in tqdm(cmc_pairs):
-            _s_sub = time.time()
-            dfs.append(save_for_one(pair, driver_path))
-            logger.debug(f"本轮用时: {(time.time()-_s_sub):.2f}s")
-    else:
-        dfs = Parallel(n_jobs=THREADS, backend="threading")(
-            delayed(save_for_one)(pair, driver_path) for pair in tqdm(cmc_pairs)
-        )
+    # 本小时 已经爬取成功的币种 不再重复爬取，只读取 本小时的parquet小文件，不读全部历史
+    # 本轮所有币种 共用同一个 candle_begin_time，即使爬取跨过整点 也不会分到两个小时
+    run_hour = current_hour()
+    done = get_done_symbols(run_hour)
+    if done:
+        cmc_pairs = [p for p in cmc_pairs if p["marketPair"] not in done]
+        logger.info("本小时 已完成 %d 个币种，跳过，剩余 %d 个", len(done), len(cmc_pairs))
+
+    # 单线程 或者 异步并发 爬取内容，每完成一个币种 就追加写入csv，中途退出也能保留已完成的部分
+    records = []
+    is_new_file = not CSV_FILE.exists()
+    with open(CSV_FILE, "a", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_COLUMNS)
+        if is_new_file:
+            writer.writeheader()
+
+        def on_record(record):
+            writer.writerow(record)
+            records.append(record)
+            if len(records) % CSV_FSYNC_ROWS == 0:
+                f.flush()
+                os.fsync(f.fileno())
+
+        if PARALLEL is False:
+            for pair in tqdm(cmc_pairs):
+                _s_sub = time.time()
+                on_record(save_for_one(pair, run_hour))
+                logger.debug("本轮用时: %.2fs", time.time() - _s_sub)
+        else:
+            asyncio.run(main_async(cmc_pairs, run_hour, on_record))
+
+        f.flush()
+        os.fsync(f.fileno())
 
-    all_df = pd.concat(dfs, ignore_index=True)
-    logger.info(f"汇总 完成：\n{all_df}")
+    # 所有币种结果 一次性 构建DataFrame
+    all_df = pd.DataFrame(records, columns=CSV_COLUMNS)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("汇总 完成：\n%s", all_df)
+
+    # 写入parquet历史数据集
+    if not all_df.empty:
+        save_parquet(all_df)
+        logger.info("写入parquet 完成")
+
+
+def compact():
+    """
+    整理csv：将candle_begin_time相同的 按照最新覆盖，最后 按时间排序
+    每轮爬取 只追加写入csv、只读取本小时的parquet，整理需要读写全部历史，
+    单独运行，例如每天一次：python fetch_cmc_turnover.py --compact
+    """
+    if platform.system() == "Linux":
+        check_running()
 
-    # 写入csv
     if not CSV_FILE.exists():
-        all_df.to_csv(str(CSV_FILE), index=False)
+        logger.warning("%s 不存在，无需整理", CSV_FILE)
+        return
+
+    # 备份当前csv，以防破坏已有数据，备份文件名 是最后写入的 candle_begin_time
+    bk_file = backup_csv()
+    if isinstance(bk_file, Path) and bk_file.exists():
+        logger.info("备份csv 完成")
     else:
-        all_df.to_csv(str(CSV_FILE), mode="a", header=False, index=False)
+        logger.warning("备份csv 失败，请检查，程序继续")
 
-    # 重新整理csv，将candle_begin_time相同的 按照最新覆盖，最后 按时间排序
     _df = format_csv()
-    logger.info(f"整理csv文件 完成:\n{_df}")
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("整理csv文件 完成:\n%s", _df)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--compact", action="store_true", help="只整理csv（去重、按时间排序），不爬取")
+    args = parser.parse_args()
 
     try:
         _s = time.time()
-        retry_wrapper(main, func_name="主程序", retry_times=2, sleep_seconds=300, if_exit=True)
-        logger.info(f"总共用时: {(time.time() - _s):.2f}s")
+        if args.compact:
+            compact()
+        else:
+            retry_wrapper(main, func_name="主程序", retry_times=2, sleep_seconds=300, max_sleep=600, if_exit=True)
+        logger.info("总共用时: %.2fs", time.time() - _s)
     except Exception as e:
-        logger.error(f"主程序错误，退出: {e}")
+        logger.error("主程序错误，退出: %s", e)
         logger.exception(e)
-    finally:
-        clear_chrom()
-        logger.info(f"Linux 清理残留 chrom 进程 完成")
@@ -0,0 +1,34 @@
+"""
+一次性脚本：把已有的 cmc_cap_vol_tor.csv 转换成 按日期分区的 parquet 数据集（date=YYYY-MM-DD/part-HH-*.parquet）
+用法：python migrate_csv_to_parquet.py
+已经有parquet文件的小时（例如 部署后 定时任务 已经跑过）会跳过，可以重复运行
+"""
+import pandas as pd
+
+from fetch_cmc_turnover import CSV_FILE, PARQUET_PATH, save_parquet, logger
+
+
+def main():
+    if not CSV_FILE.exists():
+        logger.warning("%s 不存在，无需转换", CSV_FILE)
+        return
+
+    _df = pd.read_csv(str(CSV_FILE), parse_dates=["candle_begin_time"])
+    _df = _df.drop_duplicates(subset=['symbol', 'candle_begin_time'], keep='last')
+
+    # 只转换 parquet 中还没有数据的小时，避免和 已写入的 重复
+    _hours = _df["candle_begin_time"].dt.floor("H")
+    _written = {
+        h for h in _hours.drop_duplicates()
+        if any((PARQUET_PATH / f"date={h:%Y-%m-%d}").glob(f"part-{h:%H}-*.parquet"))
+    }
+    _df = _df[~_hours.isin(_written)]
+    if _written:
+        logger.info("跳过 parquet 中已有数据的 %d 个小时", len(_written))
+
+    save_parquet(_df)
+    logger.info("转换完成，共 %d 行，写入 %s", len(_df), PARQUET_PATH)
+
+
+if __name__ == '__main__':
+    main()